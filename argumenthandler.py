@@ -1,13 +1,36 @@
 import logging
 import re
+import threading
 
 __author__ = 'szyszy'
 import argparse
 import pprint
 import yaml
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 logger = logging.getLogger(__name__)
 default_sock_url = 'ipc:///var/run/docker.sock'
+_container_patterns = {}
+# The parser only depends on the argument definitions below, build it once
+_parser = None
+_parser_lock = threading.Lock()
+
+
+def compile_container_pattern(container):
+    """Compile a 'containers-to-watch' glob to an anchored regex, reusing already compiled patterns.
+
+    Only '*' is a wildcard, everything else matches literally: '*web.1*' matches 'app_web.1_x' but not 'app_webx1'.
+    """
+    pattern = _container_patterns.get(container)
+    if pattern is None:
+        parts = container.split('*')
+        pattern = re.compile(r'\A' + '.*'.join(re.escape(part) for part in parts) + r'\Z')
+        _container_patterns[container] = pattern
+    return pattern
 
 
 class ArgumentHandler:
@@ -20,6 +43,14 @@ class ArgumentHandler:
 
     @staticmethod
     def create_parser():
+        global _parser
+        with _parser_lock:
+            if _parser is None:
+                _parser = ArgumentHandler.build_parser()
+            return _parser
+
+    @staticmethod
+    def build_parser():
         parser = argparse.ArgumentParser(description=__doc__)
         parser.add_argument('--prog', default=None,
                             help='program to call (e.g. "jq --unbuffered .")')
@@ -79,45 +110,44 @@ class ArgumentHandler:
         args.containers_to_watch = []
         if args.config_file:
             logger.info("Using config file %s", args.config_file.name)
-            data = yaml.load(args.config_file)
+            data = yaml.load(args.config_file.read(), Loader=YamlLoader)
             delattr(args, 'config_file')
             arg_dict = args.__dict__
 
-            logger.debug("Values read from config file: %s", data.items())
-            for key, value in data.items():
-                key = key.replace('-', '_')
-                if not value:
-                    logger.warn("Omitting empty value from config file for key: %s!", key)
-                    continue
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Values read from config file: %s", data.items())
+            normalized = {key.replace('-', '_'): value for key, value in data.items()}
+            for key in [key for key, value in normalized.items() if not value]:
+                logger.warning("Omitting empty value from config file for key: %s!", key)
+                del normalized[key]
+            logger.debug("Using params from config file: %s", normalized)
 
-                logger.debug("Using param from config file: %s=%s", key, value)
+            arg_dict.update((key, value) for key, value in normalized.items() if not isinstance(value, list))
+            for key, value in normalized.items():
                 if isinstance(value, list):
-                    if key not in arg_dict or arg_dict[key] is None:
+                    if arg_dict.get(key) is None:
                         arg_dict[key] = []
-                    for v in value:
-                        arg_dict[key].append(v)
-                else:
-                    arg_dict[key] = value
+                    arg_dict[key].extend(value)
 
         # initialize list if empty
         if not args.containers_to_watch:
-            args.containers_to_watch = ['.*']
+            args.containers_to_watch = ArgumentHandler.convert_containers_to_watch(['*'])
         else:
             args.containers_to_watch = ArgumentHandler.convert_containers_to_watch(args.containers_to_watch)
+        args.containers_to_watch_combined = ArgumentHandler.combine_container_patterns(args.containers_to_watch)
 
         if not args.notification_email_server:
             raise SystemExit('Container restart notifications email server is not defined, exiting...')
-        logger.debug("Command line arguments after processing: %s", pprint.pformat(args))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Command line arguments after processing: %s", pprint.pformat(args))
         return args
 
     @staticmethod
     def convert_containers_to_watch(containers):
-        result = []
         logger.info("Converting 'containers-to-watch' arguments to regex patterns: %s", containers)
-        for container in containers:
-            if '*' in container:
-                container = container.replace('*', '.*')
-            compiled_regex = re.compile(container)
-            result.append(compiled_regex)
+        return [compile_container_pattern(container) for container in containers]
 
-        return result
\ No newline at end of file
+    @staticmethod
+    def combine_container_patterns(patterns):
+        """Union compiled container patterns into one regex, so a container name is matched in a single pass."""
+        return re.compile('|'.join('(?:%s)' % pattern.pattern for pattern in patterns))
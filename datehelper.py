@@ -1,5 +1,9 @@
 import datetime
 
+# Docker event timestamps have second resolution, bursts of events share the same value
+_formatted_timestamps = {}
+_max_formatted_timestamps = 4096
+
 
 class DateHelper:
     def __init__(self):
@@ -7,4 +11,12 @@ class DateHelper:
 
     @staticmethod
     def format_timestamp(timestamp):
-        return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
\ No newline at end of file
+        # Restart times are floats, only the whole seconds are shown
+        timestamp = int(timestamp)
+        formatted = _formatted_timestamps.get(timestamp)
+        if formatted is None:
+            if len(_formatted_timestamps) >= _max_formatted_timestamps:
+                _formatted_timestamps.clear()
+            formatted = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+            _formatted_timestamps[timestamp] = formatted
+        return formatted
\ No newline at end of file
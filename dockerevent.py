@@ -1,9 +1,23 @@
 import logging
+import operator
+from sys import version_info
 
 from datehelper import DateHelper
 
+if version_info[:2] < (3, 0):
+    # intern() only takes byte strings on Python 2, parsed JSON has unicode ones
+    def intern(string):
+        return string
+else:
+    from sys import intern
+
 logger = logging.getLogger(__name__)
 
+# key is different in compose vs swarm / stack
+COMPOSE_SERVICE_KEY = 'com.docker.compose.service'
+SWARM_SERVICE_KEY = 'com.docker.swarm.service.name'
+_get_id_and_time = operator.itemgetter('id', 'time')
+
 
 class InvalidDockerEventError(Exception):
     def __init__(self, value):
@@ -13,7 +27,9 @@ class InvalidDockerEventError(Exception):
         return repr(self.value)
 
 
-class DockerEvent:
+class DockerEvent(object):
+    __slots__ = ('details', 'type', 'container_id', 'container_name', 'time', 'service_name')
+
     def __init__(self, details, event_type, event_time, container_id, container_name, service_name):
         self.details = details
         self.type = event_type
@@ -21,7 +37,11 @@ class DockerEvent:
         self.container_name = container_name
         self.time = event_time
         self.service_name = service_name
-        self.formatted_time = DateHelper.format_timestamp(event_time)
+
+    @property
+    def formatted_time(self):
+        # Most events are never printed, only format when needed
+        return DateHelper.format_timestamp(self.time)
 
     def __str__(self):
         return "type: %s, container_id: %s, container_name: %s, service_name: %s, time: %s" \
@@ -29,25 +49,16 @@ class DockerEvent:
 
     @classmethod
     def from_dict(cls, data):
-        if data.get('status'):
-            event_type = data['status']
-            container_id = data['id']
-            event_time = data['time']
-            container_name = data['Actor']['Attributes']['name']
-            # key is different in compose vs swarm / stack
-            if data['Actor']['Attributes'].get("com.docker.compose.service"):
-                service_name = data['Actor']['Attributes']["com.docker.compose.service"]
-            elif data['Actor']['Attributes'].get("com.docker.swarm.service.name"):
-                service_name = data['Actor']['Attributes']["com.docker.swarm.service.name"]
-            else:
-                raise InvalidDockerEventError(data)
-        else:
+        status = data.get('status')
+        if not status:
             # if we don't have status, it could be any other not container related event
             # e.g. network disconnect
-            event_type = None
-            container_id = None
-            container_name = None
-            service_name = None
-            event_time = data['time']
+            return cls(data, None, data['time'], None, None, None)
 
-        return cls(data, event_type, event_time, container_id, container_name, service_name)
+        attributes = data['Actor']['Attributes']
+        service_name = attributes.get(COMPOSE_SERVICE_KEY) or attributes.get(SWARM_SERVICE_KEY)
+        if not service_name:
+            raise InvalidDockerEventError(data)
+        container_id, event_time = _get_id_and_time(data)
+        # Saved events of a container share its name
+        return cls(data, status, event_time, container_id, intern(attributes['name']), service_name)
\ No newline at end of file
@@ -1,16 +1,19 @@
 #!/usr/bin/env python
 """docker monitor using docker /events HTTP streaming API"""
+import atexit
 import os
 from contextlib import closing
-from functools import partial
 from socket import AF_UNIX
 from subprocess import Popen, PIPE
 from sys import version_info
 import json
+import re
 import shlex
 import logging
 import logging.config
 import socket
+import threading
+import time
 from argumenthandler import ArgumentHandler
 import notificationservice
 from dockerevent import DockerEvent, InvalidDockerEventError
@@ -19,13 +22,43 @@ from eventbroadcaster import EventBroadcaster
 if version_info[:2] < (3, 0):
     from httplib import OK as HTTP_OK
     from urlparse import urlparse
+    from Queue import Full, Queue
 else:
     from http.client import OK as HTTP_OK
     from urllib.parse import urlparse
+    from queue import Full, Queue
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 __version__ = '0.2.2'
-bufsize = 1024
+bufsize = 65536
+tcp_rcvbuf_size = 1 << 20
+# Host header sent on TCP connections
+tcp_hostname = socket.gethostname()
 default_sock_url = 'ipc:///var/run/docker.sock'
+# Parsed events waiting for the dispatcher thread,
+# reading stops while the queue is full
+event_queue_size = 1024
+# Seconds to wait at exit for the dispatcher thread to handle the queued events
+dispatcher_stop_timeout = 10
+# Seconds between warnings about events dropped because
+# the --prog program is not reading them
+prog_drop_log_period = 60
+# Seconds to wait at exit for the --prog program to take the remaining events
+prog_close_timeout = 5
+
+# Chunked transfer framing: <size in hex>\r\n<payload>\r\n
+_CHUNK_HDR_RE = re.compile(br'([0-9a-fA-F]+)\r\n')
+# Longest size line we wait for before giving up on the stream
+_CHUNK_HDR_MAX_LEN = 18
+_MATCH_NOTHING_RE = re.compile(br'(?!)')
+_HDR_END_RE = re.compile(br'\r\n\r\n')
+# /events request around the Host value, bytes % formatting needs Python 3.5
+_EVENTS_REQUEST_PREFIX = b'GET /events HTTP/1.1\r\nHost: '
+_EVENTS_REQUEST_SUFFIX = b'\r\n\r\n'
 
 logger = logging.getLogger('dockermon')
 
@@ -34,6 +67,22 @@ class DockermonError(Exception):
     pass
 
 
+if orjson:
+    json_dumps = orjson.dumps
+
+    def json_loads_slice(buf, start, end):
+        """Parse buf[start:end] as JSON without copying it out of buf."""
+        with memoryview(buf) as view:
+            return orjson.loads(view[start:end])
+else:
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def json_loads_slice(buf, start, end):
+        """Parse buf[start:end] as JSON."""
+        return json.loads(bytes(buf[start:end]).decode('utf-8'))
+
+
 class DockerMon:
     def __init__(self, callbacks, url=default_sock_url):
         self.url = url
@@ -46,25 +95,43 @@ class DockerMon:
 
     @staticmethod
     def read_http_header(sock):
-        """Read HTTP header from socket, return header and rest of data."""
-        buf = []
-        hdr_end = '\r\n\r\n'
+        """Read HTTP header from socket.
+
+            Returns header and rest of data (bytes).
+        """
+        buf = bytearray()
+        scan = 0
 
         while True:
-            buf.append(sock.recv(bufsize).decode('utf-8'))
-            data = ''.join(buf)
-            i = data.find(hdr_end)
-            if i == -1:
+            chunk = sock.recv(bufsize)
+            if not chunk:
+                raise EOFError('socket closed')
+            if not buf:
+                # Usually the whole header arrives at once,
+                # e.g. the bodyless restart response
+                end = chunk.find(b'\r\n\r\n')
+                if end >= 0:
+                    return chunk[:end], chunk[end + 4:]
+                scan = max(0, len(chunk) - 3)
+            buf.extend(chunk)
+            m = _HDR_END_RE.search(buf, scan)
+            if m is None:
+                # Terminator may straddle two chunks
+                scan = max(0, len(buf) - 3)
                 continue
-            return data[:i], data[i + len(hdr_end):]
+            return bytes(buf[:m.start()]), bytes(buf[m.end():])
 
     @staticmethod
     def header_status(header):
-        """Parse HTTP status line, return status (int) and reason."""
-        status_line = header[:header.find('\r')]
-        # 'HTTP/1.1 200 OK' -> (200, 'OK')
-        fields = status_line.split(None, 2)
-        return int(fields[1]), fields[2]
+        """Parse HTTP status line from header (bytes).
+
+            Returns status (int) and reason.
+        """
+        # b'HTTP/1.1 200 OK' -> (200, 'OK'), the status code has a fixed offset
+        end = header.find(b'\r')
+        if end < 0:
+            end = len(header)
+        return int(header[9:12]), header[13:end].decode('utf-8')
 
     @staticmethod
     def connect(url):
@@ -75,8 +142,12 @@ class DockerMon:
         url = urlparse(url)
         if url.scheme == 'tcp':
             sock = socket.socket()
-            netloc = tuple(url.netloc.rsplit(':', 1))
-            hostname = socket.gethostname()
+            # Let the kernel queue bursts of events between reads
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                            tcp_rcvbuf_size)
+            host, port = url.netloc.rsplit(':', 1)
+            netloc = (host, int(port))
+            hostname = tcp_hostname
         elif url.scheme == 'ipc':
             sock = socket.socket(AF_UNIX)
             netloc = url.path
@@ -88,67 +159,212 @@ class DockerMon:
         return sock, hostname
 
     def watch(self):
-        """Watch docker events. Will call callback with each new event (dict).
+        """Watch docker events.
 
-            url can be either tcp://<host>:port or ipc://<path>
+            Will call callbacks and listeners with each new event (dict).
+            Events are read and parsed on the calling thread and dispatched
+            on a separate one, so slow callbacks (e.g. container restarts)
+            do not hold up reading the socket.
         """
+        events = Queue(maxsize=event_queue_size)
+        dispatcher = threading.Thread(target=self.dispatch_events,
+                                      args=(events,),
+                                      name='dockermon-dispatcher')
+        dispatcher.daemon = True
+        dispatcher.start()
+        try:
+            for event_details in self.iter_events():
+                events.put(event_details)
+        finally:
+            # Bounded, a restart may be stuck on the Docker socket
+            try:
+                events.put(None, timeout=dispatcher_stop_timeout)
+            except Full:
+                pass
+            else:
+                dispatcher.join(dispatcher_stop_timeout)
+            if dispatcher.is_alive():
+                logger.warning('Docker events are still being handled, '
+                               'not waiting for them')
+
+    def iter_events(self):
+        """Generator of docker events (dict) read from the /events API."""
         sock, hostname = DockerMon.connect(self.url)
-        request = 'GET /events HTTP/1.1\nHost: %s\n\n' % hostname
-        request = request.encode('utf-8')
-
         with closing(sock):
-            sock.sendall(request)
+            sock.sendall(b''.join((_EVENTS_REQUEST_PREFIX,
+                                   hostname.encode('utf-8'),
+                                   _EVENTS_REQUEST_SUFFIX)))
             header, payload = DockerMon.read_http_header(sock)
             status, reason = DockerMon.header_status(header)
             if status != HTTP_OK:
                 raise DockermonError('bad HTTP status: %s %s' % (status, reason))
 
-            # Messages are \r\n<size in hex><JSON payload>\r\n
-            buf = [payload]
+            # Without callbacks only broadcasted events matter,
+            # skip parsing all others
+            if self.callbacks:
+                prefilter = None
+            elif self.event_broadcaster.listeners:
+                prefilter = self.event_broadcaster.create_status_prefilter()
+            else:
+                # Nobody is interested in the payloads
+                prefilter = _MATCH_NOTHING_RE
+
+            # Messages are <size in hex>\r\n<JSON payload>\r\n,
+            # received data is in buf[head:tail]
+            buf = bytearray(max(bufsize, len(payload)))
+            buf[:len(payload)] = payload
+            head, tail = 0, len(payload)
+            view = memoryview(buf)
+            # Bound once, these are looked up for every frame
+            match_size_line = _CHUNK_HDR_RE.match
+            search_status = prefilter.search if prefilter else None
+            loads = json_loads_slice
+            recv_into = sock.recv_into
             while True:
-                chunk = sock.recv(bufsize)
-                if not chunk:
+                m = match_size_line(buf, head, tail)
+                if m is not None:
+                    start = m.end()
+                    # Python 2 int() does not take a bytearray
+                    size = int(bytes(m.group(1)), 16)
+                    end = start + size + 2  # Skip \r\n suffix
+                    if tail >= end:
+                        head = end
+                        if search_status and \
+                                not search_status(buf, start, start + size):
+                            continue
+                        yield loads(buf, start, start + size)
+                        continue
+                elif tail - head > _CHUNK_HDR_MAX_LEN:
+                    raise DockermonError(
+                        'invalid chunk size line: %r'
+                        % bytes(buf[head:head + _CHUNK_HDR_MAX_LEN]))
+
+                if head == tail:
+                    head = tail = 0
+                elif tail == len(buf):
+                    pending = tail - head
+                    if head:
+                        # Move the partial frame to the front to make room
+                        buf[:pending] = buf[head:tail]
+                        head, tail = 0, pending
+                    else:
+                        # Frame does not fit,
+                        # drop the export so buf can be resized
+                        del view
+                        buf.extend(bytearray(len(buf)))
+                        view = memoryview(buf)
+
+                n = recv_into(view[tail:])
+                if not n:
                     raise EOFError('socket closed')
-                buf.append(chunk.decode('utf-8'))
-                data = ''.join(buf)
-                i = data.find('\r\n')
-                if i == -1:
-                    continue
-
-                size = int(data[:i], 16)
-                start = i + 2  # Skip initial \r\n
-
-                if len(data) < start + size + 2:
-                    continue
-                payload = data[start:start + size]
-                event_details = json.loads(payload)
-                self.event_broadcaster.broadcast_event(event_details)
+                tail += n
 
-                if callbacks:
-                    for callback in callbacks:
-                        callback(event_details)
-
-                buf = [data[start + size + 2:]]  # Skip \r\n suffix
+    def dispatch_events(self, events):
+        """Call handle_event for each queued event, until None is taken."""
+        get_event = events.get
+        handle_event = self.handle_event
+        while True:
+            event_details = get_event()
+            if event_details is None:
+                return
+            try:
+                handle_event(event_details)
+            except Exception:
+                logger.exception('Failed to handle docker event %s',
+                                 event_details)
+
+    def handle_event(self, event_details):
+        self.event_broadcaster.broadcast_event(event_details)
+
+        if self.callbacks:
+            for callback in self.callbacks:
+                callback(event_details)
 
     @staticmethod
     def print_callback(event_details):
-        """Print callback, prints message as debug log as JSON in one line and docker event on info log"""
-        logger.debug('EVENT (json): %s' % json.dumps(event_details))
+        """Print callback, prints message as debug log
+
+            As JSON in one line and as parsed docker event.
+        """
+        # Serializing and parsing every event is wasted work
+        # if the records are dropped anyway
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        logger.debug('EVENT (json): %s',
+                     json_dumps(event_details).decode('utf-8'))
 
         try:
             docker_event = DockerEvent.from_dict(event_details)
         except InvalidDockerEventError:
-            logger.error('Invalid docker event received %s' % event_details)
+            logger.error('Invalid docker event received %s', event_details)
         else:
-            logger.debug('EVENT: %s' % docker_event)
+            logger.debug('EVENT: %s', docker_event)
+
+
+class ProgSink:
+    """Program callback, starts prog once.
+
+        Writes each message to its stdin as one line of JSON. Messages are
+        written on a separate thread. When the program does not keep up and
+        the queue is full, messages are dropped, so a stuck program never
+        holds up restarts.
+    """
+    def __init__(self, prog):
+        self.pipe = Popen(prog, stdin=PIPE, bufsize=0)
+        self.messages = Queue(maxsize=event_queue_size)
+        self.dropped = 0
+        self.next_drop_log = 0
+        self.writer = threading.Thread(target=self.write_messages,
+                                       name='dockermon-prog-writer')
+        self.writer.daemon = True
+        self.writer.start()
+        atexit.register(self.close)
+
+    def __call__(self, msg):
+        try:
+            self.messages.put_nowait(msg)
+        except Full:
+            self.dropped += 1
+            now = time.time()
+            if now >= self.next_drop_log:
+                logger.warning('Program is not reading docker events, '
+                               'dropped %s so far', self.dropped)
+                self.next_drop_log = now + prog_drop_log_period
+
+    def write_messages(self):
+        """Write queued messages to the program, until None is taken."""
+        write = self.pipe.stdin.write
+        while True:
+            msg = self.messages.get()
+            if msg is None:
+                return
+            if write is None:
+                # Keep taking messages after the program is gone,
+                # so callers never block on a full queue
+                continue
+            try:
+                write(json_dumps(msg) + b'\n')
+            except EnvironmentError:
+                logger.exception('Failed to write docker event to program, '
+                                 'dropping further events')
+                write = None
 
-    @staticmethod
-    def prog_callback(prog, msg):
-        """Program callback, calls prog with message in stdin"""
-        pipe = Popen(prog, stdin=PIPE)
-        data = json.dumps(msg)
-        pipe.stdin.write(data.encode('utf-8'))
-        pipe.stdin.close()
+    def close(self):
+        """Write the messages still queued, then close the program's stdin.
+
+            Gives up after prog_close_timeout if the program is not reading.
+        """
+        try:
+            self.messages.put(None, timeout=prog_close_timeout)
+        except Full:
+            pass
+        else:
+            self.writer.join(prog_close_timeout)
+        if self.writer.is_alive():
+            logger.warning('Program is not reading docker events, '
+                           'not waiting for it')
+        else:
+            self.pipe.stdin.close()
 
 
 if __name__ == '__main__':
@@ -188,7 +404,7 @@ if __name__ == '__main__':
             callbacks.append(DockerMon.print_callback)
         if args.prog:
             prog = shlex.split(args.prog)
-            callbacks.append(partial(DockerMon.prog_callback, prog))
+            callbacks.append(ProgSink(prog))
 
         return callbacks
 
@@ -1,4 +1,6 @@
+import re
 import time
+from collections import defaultdict, deque
 
 import logging
 
@@ -7,126 +9,148 @@ from notifyable import Notifyable
 
 logger = logging.getLogger(__name__)
 
+# Seconds to look back for a 'die' event / for the 'stop' or 'kill' event that caused it
+DIE_EVENT_MAX_AGE = 5
+STOP_OR_KILL_EVENT_MAX_AGE = 12
+# Saved events older than this are never looked at again
+MAX_EVENT_AGE = max(DIE_EVENT_MAX_AGE, STOP_OR_KILL_EVENT_MAX_AGE)
+STOP_OR_KILL_EVENTS = frozenset(('stop', 'kill'))
+# Upper bound of saved events per container, in case of event floods within MAX_EVENT_AGE
+MAX_SAVED_EVENTS = 256
+
 
 class EventBroadcaster:
     def __init__(self):
-        self.events_to_watch = ['die', 'stop', 'kill', 'start', 'health_status: healthy', 'health_status: unhealthy']
+        # docker event status -> (notify method, whether check_notify_required has to pass)
+        self.dispatch = {
+            'start': (self.notify_container_started, False),
+            'health_status: healthy': (self.notify_container_became_healthy, False),
+            'health_status: unhealthy': (self.notify_container_became_unhealthy, True),
+            'die': (self.notify_container_dead, True),
+            'stop': (self.notify_container_dead, True),
+            'kill': (self.notify_container_dead, True),
+        }
+        self.events_to_watch = frozenset(self.dispatch)
         self.listeners = []
-        self.captured_events = {}
-
-    @staticmethod
-    def event_type_matches(ev, event_type):
-        if ev.type == event_type:
-            return True
-
-    @staticmethod
-    def event_type_matches_one_of(ev, event_types):
-        for ev_type in event_types:
-            if ev.type == ev_type:
-                return True
-        return False
-
-    @staticmethod
-    def event_max_age_in_seconds(ev, max_age_in_seconds, now):
-        age_in_seconds = now - ev.time
-        if age_in_seconds <= max_age_in_seconds:
-            return True
+        # Bound listener methods per notification, looked up once at register time
+        self.started_callbacks = []
+        self.became_healthy_callbacks = []
+        self.stopped_by_hand_callbacks = []
+        self.dead_callbacks = []
+        self.became_unhealthy_callbacks = []
+        self.captured_events = defaultdict(lambda: deque(maxlen=MAX_SAVED_EVENTS))
+        self.next_captured_events_sweep = 0
+
+    def create_status_prefilter(self):
+        """Regex that finds a watched status in a raw JSON event, without parsing it.
+
+        May also match unrelated events, these are sorted out after parsing.
+        """
+        statuses = b'|'.join(re.escape(status.encode('utf-8')) for status in self.events_to_watch)
+        return re.compile(b'"(?:' + statuses + b')"')
 
     @staticmethod
     def log_propagate_event(event_type, container_name):
-        logger.debug('Propagating %s event for container: %s' % (event_type, container_name))
+        logger.debug('Propagating %s event for container: %s', event_type, container_name)
 
     def register(self, listener):
         if not isinstance(listener, Notifyable):
             raise TypeError("listener must be of type Notifyable")
         self.listeners.append(listener)
+        self.started_callbacks.append(listener.container_started)
+        self.became_healthy_callbacks.append(listener.container_became_healthy)
+        self.stopped_by_hand_callbacks.append(listener.container_stopped_by_hand)
+        self.dead_callbacks.append(listener.container_dead)
+        self.became_unhealthy_callbacks.append(listener.container_became_unhealthy)
 
-    def save_docker_event(self, event):
+    def save_docker_event(self, event, now):
         container_name = event.container_name
-        if container_name not in self.captured_events:
-            self.captured_events[container_name] = []
-
-        self.captured_events[container_name].append(event)
-        logger.debug('Saved docker event %s for container %s' % (event, container_name))
+        docker_events = self.captured_events[container_name]
+        docker_events.append(event)
+        cutoff = now - MAX_EVENT_AGE
+        while docker_events and docker_events[0].time < cutoff:
+            docker_events.popleft()
+        if now >= self.next_captured_events_sweep:
+            self.drop_stale_containers(cutoff)
+            self.next_captured_events_sweep = now + MAX_EVENT_AGE
+        logger.debug('Saved docker event %s for container %s', event, container_name)
+
+    def drop_stale_containers(self, cutoff):
+        """Forget containers without events since cutoff, e.g. removed one-off containers.
+
+            Deques emptied by save_docker_event (the saved event was already too old) are stale too.
+        """
+        stale = [container_name for container_name, docker_events in self.captured_events.items()
+                 if not docker_events or docker_events[-1].time < cutoff]
+        for container_name in stale:
+            del self.captured_events[container_name]
 
     def notify_container_started(self, docker_event):
         self.log_propagate_event('container-started', docker_event.container_name)
-        for listener in self.listeners:
-            listener.container_started(docker_event)
+        for callback in self.started_callbacks:
+            callback(docker_event)
 
     def notify_container_became_healthy(self, docker_event):
         self.log_propagate_event('container-became-healthy', docker_event.container_name)
-        for listener in self.listeners:
-            listener.container_became_healthy(docker_event)
+        for callback in self.became_healthy_callbacks:
+            callback(docker_event)
 
     def notify_container_stopped_by_hand(self, docker_event):
         self.log_propagate_event('container-stopped-by-hand', docker_event.container_name)
-        for listener in self.listeners:
-            listener.container_stopped_by_hand(docker_event)
+        for callback in self.stopped_by_hand_callbacks:
+            callback(docker_event)
 
     def notify_container_dead(self, docker_event):
         self.log_propagate_event('container-container-dead', docker_event.container_name)
-        for listener in self.listeners:
-            listener.container_dead(docker_event)
+        for callback in self.dead_callbacks:
+            callback(docker_event)
 
     def notify_container_became_unhealthy(self, docker_event):
         self.log_propagate_event('container-became-unhealthy', docker_event.container_name)
-        for listener in self.listeners:
-            listener.container_became_unhealthy(docker_event)
+        for callback in self.became_unhealthy_callbacks:
+            callback(docker_event)
 
     def broadcast_event(self, event_details):
-        if "status" in event_details:
-            try:
-                docker_event = DockerEvent.from_dict(event_details)
-            except InvalidDockerEventError:
-                logger.error('Invalid docker event received %s' % event_details)
-            else:
-                container_name = docker_event.container_name
-
-                if docker_event.type in self.events_to_watch:
-                    self.save_docker_event(docker_event)
-                    if docker_event.type == 'start':
-                        self.notify_container_started(docker_event)
-                    elif docker_event.type == 'health_status: healthy':
-                        self.notify_container_became_healthy(docker_event)
-                    elif docker_event.type == 'health_status: unhealthy':
-                        if self.check_notify_required(container_name):
-                            self.notify_container_became_unhealthy(docker_event)
-                    elif self.check_notify_required(container_name):
-                        self.notify_container_dead(docker_event)
-
-    def check_notify_required(self, container_name):
-        docker_events = self.captured_events[container_name]
+        # Nothing would read the saved events without listeners
+        if not self.listeners:
+            return
+        # Only build a DockerEvent for watched statuses
+        handler = self.dispatch.get(event_details.get('status'))
+        if handler is None:
+            return
+        try:
+            docker_event = DockerEvent.from_dict(event_details)
+        except InvalidDockerEventError:
+            logger.error('Invalid docker event received %s', event_details)
+            return
+        notify, check_required = handler
+        now = time.time()
+        self.save_docker_event(docker_event, now)
+        # Repeated die events of a crash looping container are separate crashes, restart_limit caps them
+        if not check_required or self.check_notify_required(docker_event.container_name, now):
+            notify(docker_event)
+
+    def check_notify_required(self, container_name, now):
+        # get() as indexing would add the container back after save_docker_event dropped it
+        docker_events = self.captured_events.get(container_name)
         if not docker_events:
-            logger.debug('Skipped event propagation, container %s does not have saved events' % container_name)
-            return False
-
-        die_events = self.get_die_events_from_last_period(container_name)
-        if not die_events:
-            logger.debug(
-                'Skipped event propagation, container %s does not have \'die\' events from the last period' % container_name)
+            logger.debug('Skipped event propagation, container %s does not have saved events', container_name)
             return False
 
-        stop_or_kill_events = self.get_stop_or_kill_events_from_last_period(container_name)
-        if stop_or_kill_events:
-            logger.debug(
-                'Skipped event propagation, container %s does not have \'stop\' / \'kill\' events from the last period' % container_name)
+        die_cutoff = now - DIE_EVENT_MAX_AGE
+        stop_or_kill_cutoff = now - STOP_OR_KILL_EVENT_MAX_AGE
+        has_recent_die = False
+        for e in docker_events:
+            if e.type == 'die':
+                if e.time >= die_cutoff:
+                    has_recent_die = True
+            elif e.type in STOP_OR_KILL_EVENTS and e.time >= stop_or_kill_cutoff:
+                logger.debug('Skipped event propagation, container %s has \'stop\' / \'kill\' events '
+                             'from the last period', container_name)
+                return False
+
+        if not has_recent_die:
+            logger.debug('Skipped event propagation, container %s does not have \'die\' events '
+                         'from the last period', container_name)
             return False
-        else:
-            return True
-
-    def get_die_events_from_last_period(self, container_name):
-        docker_events = self.captured_events[container_name]
-        now = time.time()
-        die_events = filter(lambda e: EventBroadcaster.event_type_matches(e, 'die'), docker_events)
-        die_events = filter(lambda e: EventBroadcaster.event_max_age_in_seconds(e, 5, now), die_events)
-        return die_events
-
-    def get_stop_or_kill_events_from_last_period(self, container_name):
-        docker_events = self.captured_events[container_name]
-        now = time.time()
-        stop_or_kill_events = filter(lambda e: EventBroadcaster.event_type_matches_one_of(e, ['stop', 'kill']),
-                                     docker_events)
-        stop_or_kill_events = filter(lambda e: EventBroadcaster.event_max_age_in_seconds(e, 12, now),
-                                     stop_or_kill_events)
-        return stop_or_kill_events
+        return True
@@ -1,10 +1,24 @@
+import atexit
 import logging
-import os
 import smtplib
 from email.mime.text import MIMEText
 import socket
+import threading
+from sys import version_info
+
+if version_info[:2] < (3, 0):
+    from Queue import Queue
+else:
+    from queue import Queue
 
 logger = logging.getLogger(__name__)
+host_hostname_filename = '/dockermon/host-hostname'
+# Read once, the host's hostname does not change while running
+_mail_hostname = None
+# Seconds to wait for the mail server on each blocking operation
+smtp_timeout = 30
+# Seconds to wait at exit for queued mails to be sent
+mail_sender_stop_timeout = 60
 
 
 #TODO Use python-commons EmailService?
@@ -13,24 +27,95 @@ class NotificationService:
         self.mail_recipient_addresses = NotificationService.get_mail_addresses(args)
         self.mail_hostname = NotificationService.get_mail_hostname()
         self.email_smtp_server = NotificationService.get_mail_server_address(args)
+        self.email_from = 'dockermon'
+        self.email_to = ', '.join(self.mail_recipient_addresses)
+        # SMTP connection kept open between mails
+        self.smtp = None
+        atexit.register(self.close_smtp)
+        # Mails are sent on a separate thread, so a slow mail server does not hold up docker events
+        self.mails = Queue()
+        self.mail_sender = threading.Thread(target=self.send_queued_mails, name='dockermon-mail-sender')
+        self.mail_sender.daemon = True
+        self.mail_sender.start()
+        atexit.register(self.stop_mail_sender)
 
     def send_mail(self, subject, msg):
+        """Queue a mail for sending."""
+        self.mails.put((subject, msg))
+
+    def send_queued_mails(self):
+        """Send mails taken from the mail queue, until None is taken."""
+        while True:
+            mail = self.mails.get()
+            if mail is None:
+                return
+            try:
+                self.send_mail_now(*mail)
+            except Exception:
+                logger.exception('Failed to send mail: %s', mail[0])
+
+    def stop_mail_sender(self):
+        """Send the mails still queued, then stop the mail sender thread.
+
+            Gives up after mail_sender_stop_timeout, so a hanging mail server cannot block exiting.
+        """
+        self.mails.put(None)
+        self.mail_sender.join(mail_sender_stop_timeout)
+        if self.mail_sender.is_alive():
+            logger.warning('Mail server did not respond in time, exiting without sending queued mails')
+
+    def send_mail_now(self, subject, msg):
         if not self.mail_recipient_addresses:
-            logger.warn('Skipping email notification as recipient email addresses are not set!')
+            logger.warning('Skipping email notification as recipient email addresses are not set!')
             return
 
         email_msg = MIMEText(str(msg))
-        email_from = 'dockermon'
-        email_to = ', '.join(self.mail_recipient_addresses)
-        email_subject = '%s: %s' % (self.mail_hostname, subject)
-
+        email_from = self.email_from
         email_msg['From'] = email_from
-        email_msg['To'] = email_to
-        email_msg['Subject'] = email_subject
-        smtp = smtplib.SMTP(self.email_smtp_server)
-        logger.info('Sending mail to email addresses %s...', email_to)
-        smtp.sendmail(email_from, self.mail_recipient_addresses, email_msg.as_string())
-        smtp.quit()
+        email_msg['To'] = self.email_to
+        email_msg['Subject'] = '%s: %s' % (self.mail_hostname, subject)
+        logger.info('Sending mail to email addresses %s...', self.email_to)
+        email_msg_str = email_msg.as_string()
+        smtp = self.get_smtp()
+        try:
+            smtp.sendmail(email_from, self.mail_recipient_addresses, email_msg_str)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException):
+            # The server refused the mail, the connection is still usable
+            raise
+        except (smtplib.SMTPException, EnvironmentError):
+            # Not retried, the server may have got the mail before the connection broke
+            self.discard_smtp()
+            raise
+
+    def get_smtp(self):
+        if self.smtp is not None:
+            # Mail servers drop idle connections, check it before sending anything on it
+            try:
+                alive = self.smtp.noop()[0] == 250
+            except (smtplib.SMTPException, EnvironmentError):
+                alive = False
+            if not alive:
+                logger.debug("SMTP connection was closed, reconnecting...")
+                self.discard_smtp()
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(self.email_smtp_server, timeout=smtp_timeout)
+        return self.smtp
+
+    def discard_smtp(self):
+        """Close a broken SMTP connection without saying goodbye to the server."""
+        try:
+            self.smtp.close()
+        finally:
+            self.smtp = None
+
+    def close_smtp(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, EnvironmentError):
+                # quit() only closes the socket when the server answered
+                self.smtp.close()
+            self.smtp = None
 
     @staticmethod
     def get_mail_addresses(args):
@@ -43,19 +128,17 @@ class NotificationService:
 
     @staticmethod
     def get_mail_hostname():
-        host_hostname_filename = '/dockermon/host-hostname'
-        if os.path.isfile(host_hostname_filename):
-            mail_hostname = open(host_hostname_filename).read().replace('\n', '')
-            logger.debug("Provided hostname of host machine %s", mail_hostname)
-
-        try:
-            mail_hostname
-        except NameError:
-            mail_hostname = 'root'
-        else:
-            pass
-        logger.debug("Hostname will be used for notification emails: %s", mail_hostname)
-        return mail_hostname
+        global _mail_hostname
+        if _mail_hostname is None:
+            try:
+                with open(host_hostname_filename) as f:
+                    mail_hostname = f.read().replace('\n', '')
+                logger.debug("Provided hostname of host machine %s", mail_hostname)
+            except EnvironmentError:
+                mail_hostname = 'root'
+            logger.debug("Hostname will be used for notification emails: %s", mail_hostname)
+            _mail_hostname = mail_hostname
+        return _mail_hostname
 
     @staticmethod
     def get_mail_server_address(args):
@@ -1,10 +1,10 @@
 import abc
 
+# Same as abc.ABC (Python 3.4+), also works on Python 2
+ABC = abc.ABCMeta('ABC', (object,), {'__slots__': ()})
 
-class Notifyable:
-    def __init__(self):
-        pass
 
+class Notifyable(ABC):
     @abc.abstractmethod
     def container_started(self, event):
         pass
@@ -1,7 +1,6 @@
-from contextlib import closing
-import json
 import logging
 import time
+from collections import deque
 
 from datehelper import DateHelper
 from dockermon import DockerMon, DockermonError
@@ -12,48 +11,83 @@ from notifyable import Notifyable
 if version_info[:2] < (3, 0):
     from httplib import NO_CONTENT as HTTP_NO_CONTENT
 else:
-    from http.client import OK as HTTP_OK
+    from http.client import NO_CONTENT as HTTP_NO_CONTENT
 
 logger = logging.getLogger(__name__)
+# Restart times are only compared to each other, so they should not jump with the wall clock (Python 2 has no monotonic)
+monotonic = getattr(time, 'monotonic', time.time)
+# Restart request around the container id and the Host value, joined as bytes (no bytes % before Python 3.5)
+_RESTART_REQUEST_PREFIX = b'POST /containers/'
+_RESTART_REQUEST_MIDDLE = b'/restart?t=5 HTTP/1.1\r\nHost: '
+_RESTART_REQUEST_SUFFIX = b'\r\nConnection: keep-alive\r\nContent-Length: 0\r\n\r\n'
+
+
+def to_wall_clock(timestamp):
+    """Convert a monotonic() timestamp to a time.time() one, for display."""
+    return time.time() - (monotonic() - timestamp)
 
 
 class RestartParameters:
     def __init__(self, args):
-        self.restart_threshold = args.restart_threshold
-        self.restart_limit = args.restart_limit
-        self.restart_reset_period = args.restart_reset_period
+        # Values from the command line are strings
+        self.restart_threshold = float(args.restart_threshold)
+        self.restart_limit = int(args.restart_limit)
+        self.restart_reset_period = float(args.restart_reset_period)
+        # Periods are configured in minutes
+        self.restart_threshold_seconds = self.restart_threshold * 60
+        self.restart_reset_period_seconds = self.restart_reset_period * 60
         self.containers_to_watch = args.containers_to_watch
+        self.containers_to_watch_combined = args.containers_to_watch_combined
         self.do_restart = args.restart_containers_on_die
 
 
-class RestartData:
+class RestartData(object):
+    __slots__ = ('container_name', 'mail_sent', 'occasions')
+
     def __init__(self, container_name, timestamp=None):
         self.container_name = container_name
         self.mail_sent = False
+        self.occasions = deque()
         if timestamp:
-            self.occasions = [timestamp]
-            self.formatted_occasions = [DateHelper.format_timestamp(timestamp)]
-        else:
-            self.occasions = []
-            self.formatted_occasions = []
+            self.occasions.append(timestamp)
 
     def add_restart_occasion(self, timestamp):
         self.occasions.append(timestamp)
-        self.formatted_occasions.append(DateHelper.format_timestamp(timestamp))
+
+    def drop_restart_occasions_before(self, timestamp):
+        occasions = self.occasions
+        while occasions and occasions[0] < timestamp:
+            occasions.popleft()
 
     def __str__(self):
         return "container_name: %s, occasions: %s, formatted_occasions: %s" \
-               % (self.container_name, self.occasions, self.formatted_occasions)
+               % (self.container_name, list(self.occasions),
+                  [DateHelper.format_timestamp(to_wall_clock(timestamp)) for timestamp in self.occasions])
+
+
+class DockerEventMailBody(object):
+    """Mail body describing a docker event, formatted only when the mail is sent."""
+    __slots__ = ('event',)
+
+    def __init__(self, event):
+        self.event = event
+
+    def __str__(self):
+        return 'Parsed event: %s\n\n\nOriginal docker event: %s\n' % (self.event, self.event.details)
 
 
 class RestartService(Notifyable):
     def __init__(self, socket_url, restart_params, notification_service):
-        Notifyable.__init__(self)
         self.socket_url = socket_url
         self.params = restart_params
         self.notification_service = notification_service
-        self.cached_container_names = {'restart': [], 'do_not_restart': []}
+        # container name -> whether it matches containers_to_watch
+        self.restartable_container_names = {}
         self.restarts = {}
+        # Docker API connection kept open between restart requests
+        self.api_sock = None
+        # Restart request after the container id, it only depends on the connection's Host value
+        self.api_request_tail = None
 
     def container_started(self, event):
         self.maintain_container_restart_counter(event.container_name)
@@ -67,11 +101,12 @@ class RestartService(Notifyable):
 
     def container_dead(self, event):
         container_name = event.container_name
-        if self.is_restart_allowed(container_name) and \
+        now = monotonic()
+        if self.is_restart_allowed(container_name, now) and \
                 self.check_container_is_restartable(container_name):
             if self.params.do_restart:
                 logger.info("Container %s dead unexpectedly, restarting...", container_name)
-                self.do_restart(event)
+                self.do_restart(event, now)
             else:
                 logger.info("Container %s dead unexpectedly, skipping restart but sending mail, as per configuration!",
                             container_name)
@@ -79,8 +114,8 @@ class RestartService(Notifyable):
                 mail_body = RestartService.create_mail_body_from_docker_event(event)
                 self.notification_service.send_mail(mail_subject, mail_body)
         else:
-            logger.warn("Container %s is stopped/killed, but WILL NOT BE restarted again, "
-                        "as maximum restart count is reached: %s", container_name, self.params.restart_limit)
+            logger.warning("Container %s is stopped/killed, but WILL NOT BE restarted again, "
+                           "as maximum restart count is reached: %s", container_name, self.params.restart_limit)
             if not self.is_mail_sent(container_name):
                 mail_subject = "Maximum restart count is reached for container %s" % container_name
                 mail_body = RestartService.create_mail_body_from_docker_event(event)
@@ -90,10 +125,12 @@ class RestartService(Notifyable):
 
     def container_became_unhealthy(self, event):
         container_name = event.container_name
-        if self.is_restart_allowed(container_name) and self.check_container_is_restartable(container_name):
+        now = monotonic()
+        if self.is_restart_allowed(container_name, now) and \
+                self.check_container_is_restartable(container_name):
             if self.params.do_restart:
                 logger.info("Container %s became unhealthy, restarting...", container_name)
-                self.do_restart(event)
+                self.do_restart(event, now)
             else:
                 logger.info("Container %s became unhealthy, skipping restart but sending mail, as per configuration!",
                             container_name)
@@ -114,97 +151,111 @@ class RestartService(Notifyable):
     def set_mail_sent(self, container_name):
         self.restarts[container_name].mail_sent = True
 
-    def save_restart_event_happened(self, container_name):
-        now = time.time()
-        if container_name not in self.restarts:
+    def save_restart_event_happened(self, container_name, now):
+        restart_data = self.restarts.get(container_name)
+        if restart_data is None:
             self.restarts[container_name] = RestartData(container_name, now)
         else:
-            self.restarts[container_name].add_restart_occasion(now)
+            restart_data.add_restart_occasion(now)
 
     def get_performed_restart_count(self, container_name):
-        if container_name not in self.restarts:
-            self.restarts[container_name] = RestartData(container_name)
-
-        return len(self.restarts[container_name].occasions)
+        restart_data = self.restarts.get(container_name)
+        return len(restart_data.occasions) if restart_data is not None else 0
 
     def reset_restart_data(self, container_name):
         self.restarts[container_name] = RestartData(container_name)
 
     def check_container_is_restartable(self, container_name):
-        if container_name in self.cached_container_names['restart']:
-            return True
-        elif container_name in self.cached_container_names['do_not_restart']:
+        restartable = self.restartable_container_names.get(container_name)
+        if restartable is None:
+            restartable = self.params.containers_to_watch_combined.match(container_name) is not None
+            if restartable and logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Container %s is matched for container name patterns %s", container_name,
+                             self.params.containers_to_watch_combined.pattern)
+            self.restartable_container_names[container_name] = restartable
+
+        if not restartable and logger.isEnabledFor(logging.DEBUG):
             logger.debug("Container %s is stopped/killed, "
                          "but WILL NOT BE restarted as it does not match any names from configuration "
                          "'containers-to-watch'.", container_name)
-            return False
-        else:
-            for pattern in self.params.containers_to_watch:
-                if pattern.match(container_name):
-                    logger.debug("Container %s is matched for container name pattern %s", container_name,
-                                 pattern.pattern)
-                    self.cached_container_names['restart'].append(container_name)
-                    return True
-            logger.debug("Container %s is stopped/killed, "
-                         "but WILL NOT BE restarted as it does not match any names from configuration "
-                         "'containers-to-watch'.", container_name)
-            self.cached_container_names['do_not_restart'].append(container_name)
-            return False
+        return restartable
 
-    def is_restart_allowed(self, container_name):
-        restart_count = self.get_performed_restart_count(container_name)
-        last_restarts = self.restarts[container_name].occasions[-self.params.restart_limit:]
-
-        now = time.time()
-        restart_range_start = now - self.params.restart_threshold * 60
-        for r in last_restarts:
-            if r < restart_range_start:
-                return False
-
-        return restart_count < self.params.restart_limit
+    def is_restart_allowed(self, container_name, now):
+        restart_data = self.restarts.get(container_name)
+        if restart_data is None:
+            restart_data = self.restarts[container_name] = RestartData(container_name)
+        # Only restarts from the threshold period count against the limit
+        restart_data.drop_restart_occasions_before(now - self.params.restart_threshold_seconds)
+        return len(restart_data.occasions) < self.params.restart_limit
 
     def maintain_container_restart_counter(self, container_name):
-        if container_name not in self.restarts:
+        restart_data = self.restarts.get(container_name)
+        if restart_data is None or not restart_data.occasions:
             return
-        last_restart = self.restarts[container_name].occasions[-1]
-        now = time.time()
-        restart_duration = now - last_restart
-        needs_counter_reset = restart_duration < self.params.restart_reset_period * 60
+        last_restart = restart_data.occasions[-1]
+        restart_duration = monotonic() - last_restart
+        needs_counter_reset = restart_duration < self.params.restart_reset_period_seconds
 
         if needs_counter_reset:
             logger.info("Start/healthy event received for container %s, clearing restart counter...",
                         container_name)
-            logger.info("Last restart time was %s", DateHelper.format_timestamp(last_restart))
+            logger.info("Last restart time was %s", DateHelper.format_timestamp(to_wall_clock(last_restart)))
             self.reset_restart_data(container_name)
 
-    def do_restart(self, event):
-        sock, hostname = DockerMon.connect(self.socket_url)
+    def do_restart(self, event, now):
         logger.info("Sending restart request to Docker API for container: %s (%s), compose service name: %s",
                     event.container_name, event.container_id, event.service_name)
-        request = self.create_docker_restart_request(event.container_id, hostname)
-        self.handle_restart_request(request, sock, event)
-
-    def handle_restart_request(self, request, sock, event):
-        with closing(sock):
-            sock.sendall(request)
-            header, payload = DockerMon.read_http_header(sock)
-            status, reason = DockerMon.header_status(header)
-
-            # checking the HTTP status, no payload should be received!
-            if status == HTTP_NO_CONTENT:
-                mail_body = RestartService.create_mail_body_from_docker_event(event)
-                self.save_restart_event_happened(event.container_name)
-                log_record = self.log_restart_container(event.container_name)
-                self.notification_service.send_mail(log_record, mail_body)
-            else:
-                raise DockermonError('bad HTTP status: %s %s' % (status, reason))
+        reused_connection = self.api_sock is not None
+        try:
+            status, reason = self.send_restart_request(event.container_id)
+        except (EnvironmentError, EOFError):
+            self.close_api_sock()
+            if not reused_connection:
+                raise
+            # Docker may have closed the idle connection since the last restart, retry once on a new one
+            logger.debug("Docker API connection was closed, reconnecting...")
+            status, reason = self.send_restart_request(event.container_id)
+        self.handle_restart_response(status, reason, event, now)
+
+    def get_api_sock(self):
+        if self.api_sock is None:
+            self.api_sock, hostname = DockerMon.connect(self.socket_url)
+            self.api_request_tail = RestartService.create_restart_request_tail(hostname)
+        return self.api_sock
+
+    def close_api_sock(self):
+        if self.api_sock is not None:
+            self.api_sock.close()
+            self.api_sock = None
+
+    def send_restart_request(self, container_id):
+        sock = self.get_api_sock()
+        sock.sendall(RestartService.create_docker_restart_request(container_id, self.api_request_tail))
+        header, payload = DockerMon.read_http_header(sock)
+        status, reason = DockerMon.header_status(header)
+        if status != HTTP_NO_CONTENT or payload:
+            # Error responses come with a body, start over with a new connection instead of reading past it
+            self.close_api_sock()
+        return status, reason
+
+    def handle_restart_response(self, status, reason, event, now):
+        # checking the HTTP status, no payload should be received!
+        if status == HTTP_NO_CONTENT:
+            mail_body = RestartService.create_mail_body_from_docker_event(event)
+            self.save_restart_event_happened(event.container_name, now)
+            log_record = self.log_restart_container(event.container_name)
+            self.notification_service.send_mail(log_record, mail_body)
+        else:
+            raise DockermonError('bad HTTP status: %s %s' % (status, reason))
 
     @staticmethod
     def create_mail_body_from_docker_event(event):
-        return 'Parsed event: %s\n\n\nOriginal docker event: %s\n' % (event, event.details)
+        return DockerEventMailBody(event)
+
+    @staticmethod
+    def create_restart_request_tail(hostname):
+        return b''.join((_RESTART_REQUEST_MIDDLE, hostname.encode('utf-8'), _RESTART_REQUEST_SUFFIX))
 
     @staticmethod
-    def create_docker_restart_request(container_id, hostname):
-        request = 'POST /containers/{0}/restart?t=5 HTTP/1.1\nHost: {1}\n\n'.format(container_id, hostname)
-        request = request.encode('utf-8')
-        return request
+    def create_docker_restart_request(container_id, request_tail):
+        return _RESTART_REQUEST_PREFIX + container_id.encode('utf-8') + request_tail
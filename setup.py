@@ -28,6 +28,7 @@ setup(
     url='https://github.com/CyberInt/dockermon',
     py_modules=['dockermon'],
     tests_require=['nose', 'flake8', 'tox'],
+    extras_require={'fast': ['orjson']},
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Developers',
@@ -1,28 +1,495 @@
 """dockermon testing"""
 
+import json
+import os
+import shutil
+import smtplib
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from argumenthandler import ArgumentHandler
 import dockermon
+from dockerevent import DockerEvent
+from dockermon import DockerMon, DockermonError, ProgSink
+import notificationservice
+from eventbroadcaster import EventBroadcaster
+from notifyable import Notifyable
+from restartservice import RestartParameters, RestartService
+
+
+class FakeSocket(object):
+    """Replays data in fixed size chunks, like a slow socket would."""
+    def __init__(self, data, chunk_size=1):
+        self.data = data
+        self.chunk_size = chunk_size
+
+    def recv(self, bufsize):
+        size = min(bufsize, self.chunk_size)
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+    def recv_into(self, buf):
+        chunk = self.recv(len(buf))
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+class RecordingListener(Notifyable):
+    """Records (notification, container name) pairs."""
+    def __init__(self):
+        self.calls = []
+
+    def container_started(self, event):
+        self.calls.append(('started', event.container_name))
+
+    def container_became_healthy(self, event):
+        self.calls.append(('healthy', event.container_name))
+
+    def container_stopped_by_hand(self, event):
+        self.calls.append(('stopped_by_hand', event.container_name))
+
+    def container_dead(self, event):
+        self.calls.append(('dead', event.container_name))
+
+    def container_became_unhealthy(self, event):
+        self.calls.append(('unhealthy', event.container_name))
+
+
+def docker_event(status, name, event_time):
+    return {'status': status, 'id': 'id-' + name, 'time': event_time,
+            'Actor': {'Attributes': {'name': name,
+                                     'com.docker.compose.service': name}}}
 
 
 def test_http_status():
-    header = 'HTTP/1.1 200 Okie Dokie\r'
-    parsed = dockermon.header_status(header)
+    header = b'HTTP/1.1 200 Okie Dokie\r'
+    parsed = DockerMon.header_status(header)
     assert parsed == (200, 'Okie Dokie')
 
 
 def test_read_http_header():
-    pass  # TBD
+    sock = FakeSocket(b'HTTP/1.1 200 OK\r\nServer: Docker\r\n\r\n4\r\n{}\r\n',
+                      chunk_size=3)
+    header, rest = DockerMon.read_http_header(sock)
+    assert header == b'HTTP/1.1 200 OK\r\nServer: Docker'
+    assert rest + sock.data == b'4\r\n{}\r\n'
+
+
+def test_restart_request():
+    tail = RestartService.create_restart_request_tail(u'localhost')
+    request = RestartService.create_docker_restart_request(u'c0ffee', tail)
+    assert request == (b'POST /containers/c0ffee/restart?t=5 HTTP/1.1\r\n'
+                       b'Host: localhost\r\nConnection: keep-alive\r\n'
+                       b'Content-Length: 0\r\n\r\n')
+
+
+class RestartArgs(object):
+    restart_threshold = '10'
+    restart_limit = '3'
+    restart_reset_period = '2'
+    containers_to_watch = None
+    containers_to_watch_combined = None
+    restart_containers_on_die = True
+
+
+class MailRecorder(object):
+    """NotificationService replacement, records mail subjects."""
+    def __init__(self):
+        self.subjects = []
+
+    def send_mail(self, subject, msg):
+        self.subjects.append(subject)
+
+
+def test_restart_limit():
+    service = RestartService('ipc:///var/run/docker.sock',
+                             RestartParameters(RestartArgs()), MailRecorder())
+    now = 1000.0
+    for _ in range(3):
+        assert service.is_restart_allowed('web', now)
+        service.save_restart_event_happened('web', now)
+    assert not service.is_restart_allowed('web', now + 1)
+    assert service.is_restart_allowed('db', now + 1)
+
+
+def test_restart_threshold_window():
+    params = RestartParameters(RestartArgs())
+    service = RestartService('ipc:///var/run/docker.sock', params,
+                             MailRecorder())
+    now = 1000.0
+    threshold = params.restart_threshold_seconds
+    for restart_time in (now, now + 60, now + 120):
+        service.save_restart_event_happened('web', restart_time)
+    assert not service.is_restart_allowed('web', now + threshold - 1)
+    # Restarts older than the threshold period stop counting
+    assert service.is_restart_allowed('web', now + threshold + 1)
+    assert list(service.restarts['web'].occasions) == [now + 60, now + 120]
+    assert service.is_restart_allowed('web', now + 120 + threshold + 1)
+    assert not service.restarts['web'].occasions
+
+
+NO_CONTENT = b'HTTP/1.1 204 No Content\r\n\r\n'
+
+
+def restart(replies, restarts):
+    """Restart a container restarts times.
+
+    Each Docker API connection answers with the next one of replies (bytes).
+    Returns the connections made.
+    """
+    # One reply per receive, like Docker answers one request at a time
+    sockets = [FakeSocket(reply, chunk_size=len(NO_CONTENT))
+               for reply in replies]
+    connected = []
+
+    def connect(url):
+        connected.append(sockets.pop(0))
+        return connected[-1], 'localhost'
+    service = RestartService('ipc:///var/run/docker.sock',
+                             RestartParameters(RestartArgs()), MailRecorder())
+    event = DockerEvent.from_dict(docker_event('die', 'web', time.time()))
+    original_connect = DockerMon.connect
+    DockerMon.connect = staticmethod(connect)
+    try:
+        for _ in range(restarts):
+            service.do_restart(event, 1000.0)
+    finally:
+        DockerMon.connect = original_connect
+    return connected
+
+
+def test_restart_reuses_connection():
+    assert len(restart([NO_CONTENT * 3], 3)) == 1
+
+
+def test_restart_retries_closed_connection_once():
+    # Docker closed the idle connection after the first restart
+    assert len(restart([NO_CONTENT, NO_CONTENT], 2)) == 2
+
+
+def test_restart_not_retried_on_new_connection():
+    try:
+        restart([b'', NO_CONTENT], 1)
+    except EOFError:
+        pass
+    else:
+        assert False, 'restart on a failing new connection was retried'
+
+
+def test_restart_error_response():
+    not_found = b'HTTP/1.1 404 Not Found\r\nContent-Length: 2\r\n\r\n{}'
+    try:
+        restart([not_found], 1)
+    except DockermonError:
+        pass
+    else:
+        assert False, 'error response was not raised'
+
+
+def container_matcher(containers_to_watch):
+    patterns = ArgumentHandler.convert_containers_to_watch(containers_to_watch)
+    combined = ArgumentHandler.combine_container_patterns(patterns)
+    return lambda name: combined.match(name) is not None
+
+
+def test_container_patterns():
+    matches = container_matcher(['web', '*web.1*', 'db*'])
+    # Each pattern is anchored at both ends
+    assert matches('web')
+    assert not matches('web2') and not matches('myweb')
+    assert matches('db') and matches('db_1') and not matches('mydb')
+    # Only * is a wildcard, the rest is matched literally
+    assert matches('app_web.1_x')
+    assert not matches('app_webx1_x')
+    brackets = container_matcher(['app[1]'])
+    assert brackets('app[1]') and not brackets('app1')
+    assert container_matcher(['*'])('anything')
+
+
+def test_broadcast_after_late_event():
+    broadcaster = EventBroadcaster()
+    listener = RecordingListener()
+    broadcaster.register(listener)
+    now = int(time.time())
+    # Too old to be kept, e.g. it waited behind slow restarts
+    broadcaster.broadcast_event(docker_event('die', 'late', now - 30))
+    broadcaster.broadcast_event(docker_event('die', 'web', now))
+    assert listener.calls == [('dead', 'web')]
+    assert 'late' not in broadcaster.captured_events
+
+
+def test_broadcast_crash_loop():
+    broadcaster = EventBroadcaster()
+    listener = RecordingListener()
+    broadcaster.register(listener)
+    now = time.time()
+    # die -> restart -> die within a second are two crashes, not duplicates
+    broadcaster.broadcast_event(docker_event('die', 'web', now))
+    broadcaster.broadcast_event(docker_event('start', 'web', now + 0.2))
+    broadcaster.broadcast_event(docker_event('die', 'web', now + 0.4))
+    assert listener.calls == [('dead', 'web'), ('started', 'web'),
+                              ('dead', 'web')]
+
+
+def events_stream(events):
+    """Chunked HTTP response of the docker /events API for events (dicts)."""
+    frames = []
+    for event in events:
+        payload = json.dumps(event).encode('utf-8')
+        size_line = ('%x\r\n' % len(payload)).encode('ascii')
+        frames.append(size_line + payload + b'\r\n')
+    header = b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+    return header + b''.join(frames)
+
+
+def fake_connect(data, chunk_size):
+    """DockerMon.connect replacement, returns a socket replaying data."""
+    def connect(url):
+        return FakeSocket(data, chunk_size), 'localhost'
+    return staticmethod(connect)
+
+
+def read_events(mon, data, chunk_size):
+    """Return events read by mon.iter_events from a socket replaying data."""
+    connect = DockerMon.connect
+    DockerMon.connect = fake_connect(data, chunk_size)
+    events = []
+    try:
+        for event in mon.iter_events():
+            events.append(event)
+    except EOFError:
+        pass
+    finally:
+        DockerMon.connect = connect
+    return events
+
+
+sample_events = [
+    docker_event('start', 'web', 1500000000),
+    {'Type': 'network', 'Action': 'connect', 'time': 1500000001},
+    docker_event('die', 'web', 1500000002),
+    docker_event('exec_create: sh', 'web', 1500000003),
+    docker_event('health_status: unhealthy', 'db', 1500000004),
+]
+
+
+def test_iter_events_split_frames():
+    # Size lines, payloads and their \r\n get split between receives
+    data = events_stream(sample_events)
+    for chunk_size in (1, 2, 5, 7, 64, len(data)):
+        assert read_events(DockerMon([len]), data, chunk_size) == sample_events
+
+
+def test_iter_events_frame_bigger_than_buffer():
+    big = docker_event('die', 'big', 1500000005)
+    big['Actor']['Attributes']['label'] = 'x' * 1000
+    events = sample_events + [big] + sample_events
+    bufsize = dockermon.bufsize
+    dockermon.bufsize = 64
+    try:
+        for chunk_size in (3, 100, 4096):
+            data = events_stream(events)
+            assert read_events(DockerMon([len]), data, chunk_size) == events
+    finally:
+        dockermon.bufsize = bufsize
+
+
+def test_iter_events_prefilter():
+    data = events_stream(sample_events)
+    watched = [sample_events[0], sample_events[2], sample_events[4]]
+    # Without callbacks only events the broadcaster dispatches on get parsed
+    mon = DockerMon([])
+    mon.register_listener(RecordingListener())
+    assert read_events(mon, data, 7) == watched
+    # Callbacks get all events
+    assert read_events(DockerMon([len]), data, 7) == sample_events
+    # Nobody is interested in any event
+    assert read_events(DockerMon([]), data, 7) == []
 
 
 def test_watch():
-    pass  # TBD
+    received = []
+    mon = DockerMon([received.append])
+    connect = DockerMon.connect
+    DockerMon.connect = fake_connect(events_stream(sample_events), 5)
+    try:
+        mon.watch()
+    except EOFError:
+        pass
+    finally:
+        DockerMon.connect = connect
+    assert received == sample_events
+
+
+def test_watch_stuck_callback():
+    # e.g. a restart hanging on the Docker socket
+    release = threading.Event()
+    mon = DockerMon([lambda event: release.wait()])
+    connect = DockerMon.connect
+    DockerMon.connect = fake_connect(events_stream(sample_events), 5)
+    stop_timeout = dockermon.dispatcher_stop_timeout
+    dockermon.dispatcher_stop_timeout = 0.1
+    started = time.time()
+    try:
+        mon.watch()
+    except EOFError:
+        pass
+    finally:
+        DockerMon.connect = connect
+        dockermon.dispatcher_stop_timeout = stop_timeout
+        release.set()
+    assert time.time() - started < 5
+
+
+class FakeSMTP(object):
+    """Records sent mails, fails the way it is told to."""
+    instances = []
+
+    def __init__(self, host, timeout):
+        self.sent = []
+        self.closed = False
+        self.noop_error = None
+        self.sendmail_error = None
+        FakeSMTP.instances.append(self)
+
+    def noop(self):
+        if self.noop_error:
+            raise self.noop_error
+        return 250, b'OK'
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if self.sendmail_error:
+            raise self.sendmail_error
+        self.sent.append(msg)
+
+    def quit(self):
+        self.close()
+
+    def close(self):
+        self.closed = True
+
+
+class MailArgs(object):
+    notification_email_addresses = ['ops@example.com']
+    notification_email_server = 'mail.example.com'
+
+
+def send_mails(*errors):
+    """Send a mail for each (noop error, sendmail error) over FakeSMTP.
+
+    Returns the exceptions raised.
+    """
+    SMTP = notificationservice.smtplib.SMTP
+    notificationservice.smtplib.SMTP = FakeSMTP
+    del FakeSMTP.instances[:]
+    service = notificationservice.NotificationService(MailArgs())
+    raised = []
+    try:
+        for noop_error, sendmail_error in errors:
+            if service.smtp is not None:
+                service.smtp.noop_error = noop_error
+                service.smtp.sendmail_error = sendmail_error
+            try:
+                service.send_mail_now('subject', 'body')
+            except Exception as e:
+                raised.append(e)
+    finally:
+        notificationservice.smtplib.SMTP = SMTP
+        service.stop_mail_sender()
+    return raised
+
+
+def test_mail_reconnect_on_dropped_connection():
+    dropped = smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+    assert send_mails((None, None), (dropped, None)) == []
+    first, second = FakeSMTP.instances
+    assert first.closed and len(first.sent) == 1
+    assert not second.closed and len(second.sent) == 1
+
+
+def test_mail_refused_not_retried():
+    refused = smtplib.SMTPRecipientsRefused({'ops@example.com': (550, b'')})
+    data_error = smtplib.SMTPDataError(554, b'Rejected')
+    raised = send_mails((None, None), (None, refused), (None, data_error),
+                        (None, None))
+    assert raised == [refused, data_error]
+    # The connection is kept, refused mails are not sent again
+    smtp, = FakeSMTP.instances
+    assert len(smtp.sent) == 2 and not smtp.closed
+
+
+def test_mail_not_resent_after_broken_connection():
+    timeout = socket.timeout('timed out')
+    raised = send_mails((None, None), (None, timeout), (None, None))
+    assert raised == [timeout]
+    first, second = FakeSMTP.instances
+    # The server may have got the mail before the timeout
+    assert first.closed and len(first.sent) == 1
+    assert len(second.sent) == 1
 
 
 def test_print_callback():
     pass
 
 
+# Copies its stdin to the file given as argument, like cat > file
+copy_prog = [sys.executable, '-c',
+             'import shutil, sys; '
+             'shutil.copyfileobj(sys.stdin, open(sys.argv[1], "w"))']
+# Never reads its stdin
+stuck_prog = [sys.executable, '-c', 'import time; time.sleep(60)']
+
+
 def test_prog_callback():
-    pass  # TBD
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'events')
+        sink = ProgSink(copy_prog + [path])
+        for event in sample_events:
+            sink(event)
+        sink.close()
+        assert sink.pipe.wait() == 0
+        with open(path) as f:
+            assert [json.loads(line) for line in f] == sample_events
+        assert sink.dropped == 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_prog_callback_stuck_program():
+    event = docker_event('die', 'web', 1500000000)
+    # Bigger than the pipe buffer, the writer blocks on the first one
+    event['Actor']['Attributes']['label'] = 'x' * 65536
+    queue_size = dockermon.event_queue_size
+    close_timeout = dockermon.prog_close_timeout
+    dockermon.event_queue_size = 4
+    dockermon.prog_close_timeout = 0.1
+    try:
+        sink = ProgSink(stuck_prog)
+        # More than the pipe and the queue can hold, none of these block
+        for _ in range(20):
+            sink(event)
+            time.sleep(0.01)
+        # One message is stuck in the pipe, 4 wait in the queue
+        assert sink.dropped >= 20 - 1 - 4
+        started = time.time()
+        sink.close()
+        assert time.time() - started < 1
+        assert sink.writer.is_alive()
+    finally:
+        dockermon.event_queue_size = queue_size
+        dockermon.prog_close_timeout = close_timeout
+        sink.pipe.kill()
+        sink.pipe.wait()
 
 
 def test_main():